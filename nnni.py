@@ -1,177 +1,151 @@
 """
 Neural Networks with No Imports (in Python).
-"""
-
-MERSENNE_PRIME = 162259276829213363391578010288127
-A = 2305843009213693951
-B = 15485863
 
-def random(seed):
-    """Pseudo-random number generator in the range [0, 1).
+The neural network is implemented by hand on top of a Matrix class whose
+storage and arithmetic come from NumPy, the one import of this script.
+"""
 
-    “Mersenne prime twister”."""
+import numpy as np
 
-    state = seed
-    for _ in range(20):
-        state = (state*A + B) % MERSENNE_PRIME
-    while True:
-        state = (state*A + B) % MERSENNE_PRIME
-        cand = state/(MERSENNE_PRIME + 1)
-        # Ignore the first 3 decimal places.
-        yield 1000*cand - int(1000*cand)
+_rng = np.random.default_rng(73)
 
-def ensure_other_is_scalar(matrix_method):
-    """Simple decorator to check if second argument to a matrix method is a scalar."""
-    def wrapper(self, other, *args, **kwargs):
-        if not isinstance(other, (int, float, complex)):
-            raise ValueError(f"Cannot use {matrix_method} with 'other' of type {type(other)}.") 
-        return matrix_method(self, other, *args, **kwargs)
-    return wrapper
+def _as_array(other):
+    """The components of other if it is a matrix, otherwise other itself."""
+    return other.arr if isinstance(other, Matrix) else other
 
 class Matrix:
-    """Represents a matrix with numerical components."""
+    """Represents a matrix with numerical components.
 
-    rand_generator = random(id(73))
+    The components are stored in a float32 NumPy array, self.arr. That array
+    may be a view shared with another matrix (see t()), and the training code
+    updates some arrays in place, so writing to self.arr can change other
+    matrices too."""
 
     def __init__(self, data, nrows=None, ncols=None):
         """(nrows, ncols) gives the shape of the matrix and
         data populates the matrix."""
 
-        self.nrows = nrows if nrows is not None else len(data)
-        self.ncols = ncols if ncols is not None else len(data[0])
-
         if isinstance(data, (int, float, complex)):
-            data = [[data for _ in range(self.ncols)] for _ in range(self.nrows)]
-        self.data = data
+            self.arr = np.full((nrows, ncols), data, dtype=np.float32)
+        else:
+            self.arr = np.asarray(data, dtype=np.float32)
+
+    @property
+    def nrows(self):
+        return self.arr.shape[0]
+
+    @property
+    def ncols(self):
+        return self.arr.shape[1]
 
     def size(self):
-        return self.nrows*self.ncols
+        return self.arr.size
 
     def t(self):
-        return Matrix(
-            [[self.data[r][c] for r in range(self.nrows)] for c in range(self.ncols)]
-        )
+        """Transpose of the matrix, as a view that shares the components.
+
+        The result aliases this matrix: writing to its components changes this
+        matrix as well, and its array is not contiguous. Matrix.dot hands the
+        strided view straight to BLAS, which handles the transposition itself,
+        so no copy is ever made."""
+        return Matrix(self.arr.T)
 
     def __add__(self, other):
         """Add two matrices or a matrix and a scalar."""
 
-        if isinstance(other, (int, float, complex)):
-            return self.map(lambda elem: elem + other)
-        elif isinstance(other, Matrix):
-            return Matrix.interleave(lambda l, r: l + r, self, other)
-        else:
-            raise ValueError(f"Cannot add a matrix with {type(other)}.")
+        if isinstance(other, Matrix):
+            return Matrix(self.arr + other.arr)
+        return Matrix(self.arr + other)
+
+    __radd__ = __add__
 
     def __sub__(self, other):
         """Subtract a matrix or a scalar from a matrix."""
-        return self + (-1*other)
+
+        if isinstance(other, Matrix):
+            return Matrix(self.arr - other.arr)
+        return Matrix(self.arr - other)
+
+    def __rsub__(self, other):
+        """Subtract a matrix from a scalar."""
+        return Matrix(other - self.arr)
 
     def __mul__(self, other):
-        """Multiply a matrix with a scalar."""
+        """Multiply a matrix with a scalar or, component-wise, with another matrix."""
 
-        if isinstance(other, (int, float, complex)):
-            return self.map(lambda elem: elem * other)
-        elif isinstance(other, Matrix):
-            return Matrix.interleave(lambda l, r: l * r, self, other)
-        else:
-            raise ValueError(f"Cannot multiply a matrix with {type(other)}.")
+        if isinstance(other, Matrix):
+            return Matrix(self.arr * other.arr)
+        return Matrix(self.arr * other)
 
-    @ensure_other_is_scalar
-    def __rmul__(self, other):
-        return self*other
+    __rmul__ = __mul__
 
-    @ensure_other_is_scalar
     def __truediv__(self, other):
-        return self*(1/other)
+        return Matrix(self.arr / other)
 
-    @ensure_other_is_scalar
     def __pow__(self, other, modulo=None):
         if modulo is None:
-            return self.map(lambda elem: pow(elem, other))
+            return Matrix(self.arr ** other)
         else:
-            return self.map(lambda elem: pow(elem, other, modulo))
+            return Matrix(np.mod(self.arr ** other, modulo))
 
-    @ensure_other_is_scalar
     def __lt__(self, other):
-        return self.map(lambda elem: int(elem < other))
+        return Matrix(self.arr < _as_array(other))
 
-    @ensure_other_is_scalar
     def __le__(self, other):
-        return self.map(lambda elem: int(elem <= other))
+        return Matrix(self.arr <= _as_array(other))
 
-    @ensure_other_is_scalar
-    def __eq__(self, other):
-        return self.map(lambda elem: int(elem == other))
+    # eq and ne are methods rather than __eq__/__ne__ so that matrices keep
+    # identity equality and hashing and can be used in sets and as dict keys.
+    # Unlike the ordering operators above, m == 0 is therefore just False.
+    def eq(self, other):
+        return Matrix(self.arr == _as_array(other))
 
-    @ensure_other_is_scalar
-    def __ne__(self, other):
-        return self.map(lambda elem: int(elem != other))
+    def ne(self, other):
+        return Matrix(self.arr != _as_array(other))
 
-    @ensure_other_is_scalar
     def __gt__(self, other):
-        return self.map(lambda elem: int(elem > other))
+        return Matrix(self.arr > _as_array(other))
 
-    @ensure_other_is_scalar
     def __ge__(self, other):
-        return self.map(lambda elem: int(elem >= other))
+        return Matrix(self.arr >= _as_array(other))
 
     def map(self, f):
-        """Map a function over all components of the matrix."""
-        return Matrix([[f(elem) for elem in row] for row in self.data])
+        """Map a ufunc over all components of the matrix."""
+        return Matrix(f(self.arr))
 
     @staticmethod
     def interleave(f, m1, m2):
-        """Apply f on the corresponding pairs of elements of the two matrices."""
-        data = []
-        for row1, row2 in zip(m1.data, m2.data):
-            data.append([f(e1, e2) for e1, e2 in zip(row1, row2)])
-        return Matrix(data)
+        """Apply the binary ufunc f on the corresponding pairs of elements of the two matrices."""
+        return Matrix(f(m1.arr, m2.arr))
 
     @staticmethod
     def maximum(m1, m2):
-        """Returns the component-wise maximum between two matrices."""
-
-        if isinstance(m2, (int, float, complex)):
-            return m1.map(lambda elem: max(elem, m2))
-        elif isinstance(m2, Matrix):
-            return Matrix.interleave(max, m1, m2)
-        else:
-            raise ValueError(f"Cannot find matrix maximum with argument of type {type(m2)}.")
+        """Returns the component-wise maximum between a matrix and a matrix or scalar."""
+        return Matrix(np.maximum(m1.arr, _as_array(m2)))
 
     def argmax(self):
         """Returns the index of the largest value in the matrix."""
-        idx = (0, 0)
-        m = self.data[0][0]
-        for r, row in enumerate(self.data):
-            for c, elem in enumerate(row):
-                if elem > m:
-                    m = elem
-                    idx = (r, c)
-        return idx
+        return np.unravel_index(self.arr.argmax(), self.arr.shape)
 
     @staticmethod
-    def dot(m1, m2):
-        """Perform matrix multiplication."""
+    def dot(m1, m2, out=None):
+        """Perform matrix multiplication.
+
+        If given, the result is written into the matrix out, which is returned."""
 
         # Check if the shapes of the matrices are compatible.
         if m1.ncols != m2.nrows:
             raise ValueError(
                 f"Cols of left matrix ({m1.ncols}) != rows of right matrix ({m2.nrows})."
             )
-        # Compute the data of the resulting matrix.
-        data = []
-        for r in range(m1.nrows):
-            row = []
-            for c in range(m2.ncols):
-                row.append(
-                    sum(m1.data[r][i]*m2.data[i][c] for i in range(m1.ncols))
-                )
-            data.append(row)
-        return Matrix(data)
+        if out is not None:
+            np.matmul(m1.arr, m2.arr, out=out.arr)
+            return out
+        return Matrix(m1.arr @ m2.arr)
 
     @staticmethod
     def mean(m):
-        return sum(sum(row) for row in m.data)/(m.size())
+        return float(m.arr.mean())
 
     @staticmethod
     def random(nrows, ncols):
@@ -180,10 +154,7 @@ class Matrix:
         The values are drawn from the uniform distribution in [-1, 1].
         """
 
-        return Matrix(
-            [[2*next(Matrix.rand_generator) - 1 for _ in range(ncols)]
-            for _ in range(nrows)]
-        )
+        return Matrix(_rng.uniform(-1.0, 1.0, (nrows, ncols)).astype(np.float32))
 
 class ActivationFunction:
     """'Abstract base class' for activation functions."""
@@ -198,11 +169,10 @@ class LeakyReLU(ActivationFunction):
         self.alpha = alpha
 
     def f(self, x):
-        return Matrix.maximum(x, self.alpha*x)
+        return Matrix(np.where(x.arr > 0, x.arr, self.alpha*x.arr))
 
     def df(self, x):
-        # return Matrix.maximum()
-        return Matrix.maximum(x > 0, self.alpha)
+        return Matrix(np.where(x.arr > 0, np.float32(1), np.float32(self.alpha)))
 
 class LossFunction:
     """'Abstract base class' for loss functions."""
@@ -216,7 +186,9 @@ class LossFunction:
 class MSELoss(LossFunction):
     """Mean Squared Error loss function."""
     def loss(self, output, target):
-        return Matrix.mean((output - target)**2)
+        diff = output.arr - target.arr
+        diff *= diff
+        return float(diff.mean())
 
     def dloss(self, output, target):
         return 2*(output - target)/(output.size())
@@ -227,12 +199,23 @@ class Layer:
         self.ins = ins
         self.outs = outs
         self.act_function = act_function
+        # Bound once here so the hot loops skip the attribute lookups.
+        self.act_f = act_function.f
+        self.act_df = act_function.df
         self.W = Matrix.random(outs, ins)/(outs * ins)
         self.b = Matrix.random(outs, 1)/outs
 
+    def affine(self, x, out=None):
+        """Compute W·x + b, adding the bias in place to the product.
+
+        If given, the result is written into the matrix out."""
+        y = Matrix.dot(self.W, x, out)
+        y.arr += self.b.arr
+        return y
+
     def forward_pass(self, x):
         """Propagate information forward."""
-        return self.act_function.f(Matrix.dot(self.W, x) + self.b)
+        return self.act_f(self.affine(x))
 
 class NeuralNetwork:
     """An ordered collection of compatible layers."""
@@ -246,6 +229,19 @@ class NeuralNetwork:
             if l1.outs != l2.ins:
                 raise ValueError(f"Layers are not compatible ({l1.outs} != {l2.ins}).")
 
+        # Scratch matrices reused by every training step: the weight gradients
+        # and, for each batch size seen so far, the pre-activations.
+        self._dW_bufs = [Matrix(0, layer.outs, layer.ins) for layer in layers]
+        self._y_bufs = {}
+
+    def _pre_activation_buffers(self, batch_size):
+        """Get the pre-activation scratch matrices for a batch size."""
+        if batch_size not in self._y_bufs:
+            self._y_bufs[batch_size] = [
+                Matrix(0, layer.outs, batch_size) for layer in self.layers
+            ]
+        return self._y_bufs[batch_size]
+
     def forward_pass(self, x):
         """Propagate a vector through the whole network."""
 
@@ -260,19 +256,37 @@ class NeuralNetwork:
 
     def train(self, x, t):
         """Train the network so that net.forward_pass(x) becomes closer to t."""
-
-        xs = [x]
-        for layer in self.layers:
-            xs.append(layer.forward_pass(xs[-1]))
-
-        dx = self.loss_function.dloss(xs.pop(), t)
-        for layer, x in zip(self.layers[::-1], xs[::-1]):
-            y = Matrix.dot(layer.W, x) + layer.b
-            db = layer.act_function.df(y) * dx
-            dW = Matrix.dot(db, x.t())
-
-            layer.W = layer.W - self.lr * dW
-            layer.b = layer.b - self.lr * db
+        self.train_batch(x, t)
+
+    def train_batch(self, X, T):
+        """Train the network on a mini-batch of samples.
+
+        X and T hold one sample per column, so each layer does a single
+        matrix multiplication for the whole batch and the gradients are
+        summed over the columns."""
+
+        # Keep the pre-activations around so the backward pass doesn't recompute them.
+        xs = [X]
+        ys = self._pre_activation_buffers(X.ncols)
+        for layer, y in zip(self.layers, ys):
+            layer.affine(xs[-1], out=y)
+            xs.append(layer.act_f(y))
+
+        dx = self.loss_function.dloss(xs.pop(), T)
+        # The loss averages over the whole batch; scale its gradient back up
+        # so that each sample contributes its full gradient and they add up.
+        dx.arr *= X.ncols
+        for layer, x, y, dW in zip(
+            self.layers[::-1], xs[::-1], ys[::-1], self._dW_bufs[::-1]
+        ):
+            db = layer.act_df(y)
+            db.arr *= dx.arr
+            Matrix.dot(db, x.t(), out=dW)
+
+            # Update the parameters in place.
+            dW.arr *= self.lr
+            layer.W.arr -= dW.arr
+            layer.b.arr -= self.lr * db.arr.sum(axis=1, keepdims=True)
 
             dx = Matrix.dot(layer.W.t(), db)
 
@@ -311,41 +325,43 @@ if __name__ == "__main__":
     net = NeuralNetwork(layers, MSELoss(), 0.001)
 
     def load_data(path):
-        """Load MNIST data from a CSV file."""
+        """Load MNIST data from a CSV file.
+
+        Returns the digits and a (784, N) matrix with one image per column,
+        with the pixel intensities scaled from 0-255 down to [0, 1]."""
 
         print(f"Now loading {path}...", end="")
-        with open(path, "r") as f:
-            lines = f.read().split("\n")[:-1]
-        # Convert each number to an integer.
-        data = [list(map(int, line.split(","))) for line in lines]
+        data = np.loadtxt(path, delimiter=",", dtype=np.int16, ndmin=2)
         print(" Done loading.")
-        # Reformat the data into the (digit, pixels) format.
-        return [(l[0], Matrix([l[1:]]).t()) for l in data]
+        pixels = data[:, 1:].T.astype(np.float32)
+        pixels /= 255
+        return data[:, 0], Matrix(pixels)
 
     def test(net, test_data):
-        # test_data is a list with (digit, pixels) pairs.
-        correct = 0
-        for i, (digit, pixels) in enumerate(test_data):
-            if not i%1000:
-                print(i)
-            out = net.forward_pass(pixels)
-            guess = out.argmax()[0]
-            if guess == digit:
-                correct += 1
-
-        return correct/len(test_data)
-
-    def train(net, train_data):
-        ts = {}
-        for digit in range(10):
-            t = Matrix(0, 10, 1)
-            t.data[digit][0] = 1
-            ts[digit] = t
-
-        for i, (digit, pixels) in enumerate(train_data):
-            if not i % 1000:
-                print(i)
-            net.train(pixels, ts[digit])
+        # Run all the images through the network as a single batch.
+        digits, pixels = test_data
+        out = net.forward_pass(pixels)
+        guesses = out.arr.argmax(axis=0)
+        return float((guesses == digits).mean())
+
+    def train(net, train_data, batch_size=64):
+        digits, pixels = train_data
+        # (10, N) one-hot targets, one column per image.
+        targets = np.eye(10, dtype=np.float32)[digits].T
+
+        # Slice the images and targets into mini-batches.
+        batches = []
+        for i in range(0, len(digits), batch_size):
+            X = Matrix(pixels.arr[:, i:i + batch_size])
+            T = Matrix(targets[:, i:i + batch_size])
+            batches.append((X, T))
+
+        for i, (X, T) in enumerate(batches):
+            # Report progress whenever another 1000 samples have been reached.
+            seen = i * batch_size
+            if not i or seen // 1000 != (seen - batch_size) // 1000:
+                print(seen)
+            net.train_batch(X, T)
 
     test_data = load_data("mnistdata/mnist_test.csv")
     print("Testing...")